@@ -1,29 +1,179 @@
+import argparse
+import gzip
 import os
+import sys
+import threading
+from concurrent.futures import (
+    ThreadPoolExecutor,
+)
+from collections import (
+    deque,
+)
+from contextlib import (
+    contextmanager,
+)
+from functools import (
+    cached_property,
+)
+from itertools import (
+    chain,
+    islice,
+)
 from pathlib import (
     Path,
 )
 import json
+import shelve
+import tempfile
+import requests
+from requests.adapters import (
+    HTTPAdapter,
+)
+from urllib3.util.retry import (
+    Retry,
+)
 import spotipy
 from spotipy.oauth2 import (
     SpotifyOAuth,
 )
 from spotdl import Spotdl
+from spotdl.utils.formatter import (
+    create_file_name,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 BASE_PATH = os.environ.get("BASE_PATH")
+REQUIRED_ENV = [
+    "USERNAME",
+    "SPOTIPY_CLIENT_ID",
+    "SPOTIPY_CLIENT_SECRET",
+    "SPOTIPY_REDIRECT_URI",
+]
 NUM_THREADS = 4
+PLAYLIST_PAGE_SIZE = 50 # max is 50 records per page
+PLAYLIST_PAGE_WORKERS = 4
 MAX_DOWNLOAD_RETRIES = 5
+MAX_API_RETRIES = 15
+SEARCH_WORKERS = 2
+MAP_FILE = "snapshot_map.json.gz"
+# uncompressed map written by earlier versions, read if MAP_FILE is missing
+LEGACY_MAP_FILE = "snapshot_map.json"
+MAP_LOG_FILE = "snapshot_map.jsonl"
+ETAG_CACHE_FILE = "etag_cache"
+SONG_CACHE_FILE = "song_cache"
+
+def json_dumps(obj, sort_keys=False):
+    """
+    Serialize `obj` to compact UTF-8 bytes, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, separators=(",", ":"), sort_keys=sort_keys).encode()
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def stream_dump(m, f):
+    """
+    Write `m` to the binary file `f` sorted by key, one top-level entry per
+    line, without serializing the whole map into a single buffer.
+    """
+    f.write(b"{")
+    for i, k in enumerate(sorted(m)):
+        f.write(b",\n    " if i else b"\n    ")
+        f.write(json_dumps(k) + b": " + json_dumps(m[k], sort_keys=True))
+    f.write(b"\n}\n")
+
+class ETagSession(requests.Session):
+    """
+    Session that revalidates GET requests with If-None-Match and replays the
+    cached body when Spotify answers 304 Not Modified.
+    """
+    def __init__(self, cache_file=ETAG_CACHE_FILE):
+        super().__init__()
+        # url -> (etag, body)
+        self.cache = shelve.open(cache_file)
+        # shelve is not thread safe and pages are fetched concurrently
+        self._cache_lock = threading.Lock()
+        # more patient than spotipy's default (3 tries, 0.3 backoff) so that
+        # 429s from the concurrent page fetches back off instead of failing
+        retry = Retry(
+            total=MAX_API_RETRIES,
+            connect=None,
+            read=False,
+            allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+            status=MAX_API_RETRIES,
+            backoff_factor=2,
+            status_forcelist=spotipy.Spotify.default_retry_codes,
+        )
+        # keep enough pooled connections alive for the concurrent page fetches
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=retry,
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def send(self, request, **kwargs):
+        cached = None
+        if request.method == "GET":
+            with self._cache_lock:
+                cached = self.cache.get(request.url)
+        if cached:
+            request.headers["If-None-Match"] = cached[0]
+        response = super().send(request, **kwargs)
+        if cached and response.status_code == 304:
+            response.status_code = 200
+            response._content = cached[1]
+        elif request.method == "GET" and response.status_code == 200:
+            if etag := response.headers.get("ETag"):
+                with self._cache_lock:
+                    self.cache[request.url] = (etag, response.content)
+        return response
+
+    def close(self):
+        with self._cache_lock:
+            self.cache.close()
+        super().close()
 
 class SpotifyClient():
     def __init__(self):
+        # fail before touching the token cache or the network
+        if missing := [k for k in REQUIRED_ENV if not os.environ.get(k)]:
+            raise SystemExit(f"Missing environment variables: {', '.join(missing)}")
         self.username = os.environ.get("USERNAME")
         self.scope = "playlist-read-private"
+        # token refreshes and API calls share one connection pool
+        self.session = ETagSession()
         self.auth_manager = SpotifyOAuth(
             scope=self.scope,
             open_browser=False,
+            requests_session=self.session,
+        )
+        self.sp = spotipy.Spotify(
+            auth_manager=self.auth_manager,
+            requests_session=self.session,
         )
-        self.sp = spotipy.Spotify(auth_manager=self.auth_manager)
         self.playlists = None
         self.target_snapshot_map = {}
+        # append-only log of entries saved since the last compaction
+        self._log = open(MAP_LOG_FILE, "ab")
+        self._drop_torn_log_tail()
+        # entries held back by `batched_save`, None when not batching
+        self._pending = None
+        self._flush_every = None
+
+    def close(self):
+        # closes the ETag shelf too, rather than leaving it to spotipy's __del__
+        self.session.close()
+        self._log.close()
 
     def get_playlists(self):
         return self.sp.user_playlists(
@@ -44,122 +194,319 @@ class SpotifyClient():
         else:
             self.playlists = None
     
+    def get_playlists_page(self, offset):
+        return self.sp.user_playlists(
+            self.username,
+            limit=PLAYLIST_PAGE_SIZE,
+            offset=offset,
+        )
+
     def build_snapshot_map(self):
         snapshot_map = {}
-        playlists = self.sp.user_playlists(self.username)
-        while playlists is not None:
-            for playlist_obj in playlists.get("items"):
-                owner_id = playlist_obj.get("owner").get("id")
-                if owner_id == self.username:
-                    snapshot_id = playlist_obj.get("snapshot_id")
-                    name = playlist_obj.get("name")
-                    url = playlist_obj.get("external_urls").get("spotify")
-                    snapshot_map[name] = {
-                        "url": url,
-                        "snapshot_id": snapshot_id,
-                    }
-            if playlists['next']:
-                playlists = self.sp.next(playlists)
-            else:
-                playlists = None
+        # the first page tells us how many playlists there are, so the
+        # remaining pages can be requested concurrently by offset
+        first_page = self.get_playlists_page(0)
+        offsets = range(PLAYLIST_PAGE_SIZE, first_page["total"], PLAYLIST_PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=PLAYLIST_PAGE_WORKERS) as executor:
+            # map yields pages in offset order, matching the serial walk
+            pages = chain([first_page], executor.map(self.get_playlists_page, offsets))
+            for playlists in pages:
+                for playlist_obj in playlists.get("items"):
+                    owner_id = playlist_obj.get("owner").get("id")
+                    if owner_id == self.username:
+                        snapshot_id = playlist_obj.get("snapshot_id")
+                        name = playlist_obj.get("name")
+                        url = playlist_obj.get("external_urls").get("spotify")
+                        snapshot_map[name] = {
+                            "url": url,
+                            "snapshot_id": snapshot_id,
+                        }
         return snapshot_map
 
     def dump_map(self, m):
-        with open("snapshot_map.json", "w") as snapshot_file:
-            json.dump(m, snapshot_file, indent=4, sort_keys=True)
+        """
+        Atomically replace the snapshot map with `m` and clear the log.
+        """
+        # serialize and compress up front so the file is written with a
+        # single write call instead of many small ones through GzipFile.
+        # level 1 is nearly free next to the fsync and still shrinks the
+        # repeated keys several times over
+        buf = memoryview(gzip.compress(json_dumps(m), compresslevel=1, mtime=0))
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(MAP_FILE)),
+            prefix=".snapshot_map.",
+        )
+        try:
+            try:
+                while buf:
+                    buf = buf[os.write(fd, buf):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            # mkstemp creates the file 0600; give it the mode a plain open()
+            # would, which honours the user's umask
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+            os.replace(temp_path, MAP_FILE)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self._log.truncate(0)
 
     def incremental_dump_map(self, entry):
         """
+        Append a single entry to the snapshot log instead of rewriting the
+        whole map. Entries are folded back in by `load_snapshot_map`.
+
         Parameters
         -----------
             entry: tuple(str, dict)
         """
-        with open("snapshot_map.json", "r") as snapshot_file:
-            if res := snapshot_file.read():
-                data = json.loads(res)
-            else:
-                data = {}
+        if self._pending is None:
+            self._append_log([entry])
+            return
+        self._pending.append(entry)
+        if len(self._pending) >= self._flush_every:
+            self._flush_pending()
+
+    def _drop_torn_log_tail(self):
+        """
+        Cut a line left half-written by a crash off the end of the log, so
+        the next append starts on a line of its own.
+        """
+        data = Path(MAP_LOG_FILE).read_bytes()
+        if data and not data.endswith(b"\n"):
+            self._log.truncate(data.rfind(b"\n") + 1)
+
+    def _append_log(self, entries):
+        self._log.write(b"".join(json_dumps({k: v}) + b"\n" for k, v in entries))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def _flush_pending(self):
+        if self._pending:
+            self._append_log(self._pending)
+            self._pending.clear()
+
+    @contextmanager
+    def batched_save(self, flush_every=8):
+        """
+        Group entries passed to `incremental_dump_map` and write them to the
+        log `flush_every` at a time, so a crash loses at most that many.
+        """
+        self._pending = []
+        self._flush_every = flush_every
+        try:
+            yield self
+        finally:
+            self._flush_pending()
+            self._pending = None
 
-        k, v = entry
-        data[k] = v
+    def compact(self):
+        self._flush_pending()
+        self.dump_map(self.load_snapshot_map())
 
-        with open("snapshot_map.json", "w") as snapshot_file:
-            json.dump(data, snapshot_file, indent=4, sort_keys=True)
+    @staticmethod
+    def pretty_dump(f=None):
+        """
+        Write the current snapshot map, sorted and indented, for a human.
+        Only reads local files, so no Spotify client or credentials needed.
+        """
+        stream_dump(SpotifyClient.load_snapshot_map(), f or sys.stdout.buffer)
 
     def dump_snapshot_map(self):
         self.dump_map(self.build_snapshot_map())
 
     def get_snapshot_diff(self):
         playlists_to_update = []
-        prev_map = self.load_snapshot_map()
+        # only the snapshot ids are compared, so pull them out once
+        prev_snapshot_ids = {
+            name: obj.get("snapshot_id")
+            for name, obj in self.load_snapshot_map().items()
+        }
         target_snapshot_map = self.build_snapshot_map()
-        count = 0
-        for playlist_name in target_snapshot_map.keys():
-            playlist_obj = target_snapshot_map.get(playlist_name)
-            playlist_snapshot_id = playlist_obj.get("snapshot_id")
-            prev_playlist_obj = prev_map.get(playlist_name)
-            if prev_playlist_obj:
-                prev_playlist_snapshot_id = prev_playlist_obj.get("snapshot_id")
-                if playlist_snapshot_id != prev_playlist_snapshot_id:
-                    print(f"Playlist '{playlist_name}' was updated. Download again: {playlist_obj}")
-                    playlists_to_update.append({"name": playlist_name, "url": playlist_obj.get("url")})
-                    count += 1
-            else:
+        # new and changed names via dict_keys set operations, done in C
+        target_names = target_snapshot_map.keys()
+        added = target_names - prev_snapshot_ids.keys()
+        updated = {
+            name
+            for name in target_names & prev_snapshot_ids.keys()
+            if prev_snapshot_ids[name] != target_snapshot_map[name]["snapshot_id"]
+        }
+        # walk the target map so the queue keeps Spotify's playlist order
+        for playlist_name, playlist_obj in target_snapshot_map.items():
+            if playlist_name in added:
                 print(f"Playlist '{playlist_name}' was added")
-                playlists_to_update.append({"name": playlist_name, "url": playlist_obj.get("url")})
-                count += 1
-        print(f"{count} playlists should be updated.")
+            elif playlist_name in updated:
+                print(f"Playlist '{playlist_name}' was updated. Download again: {playlist_obj}")
+            else:
+                continue
+            playlists_to_update.append({
+                "name": playlist_name,
+                "url": playlist_obj["url"],
+                "snapshot_id": playlist_obj["snapshot_id"],
+            })
+        print(f"{len(playlists_to_update)} playlists should be updated.")
         self.target_snapshot_map = target_snapshot_map
         return playlists_to_update
 
-    def load_snapshot_map(self):
-        with open("snapshot_map.json") as snapshot_file:
-            if data := snapshot_file.read():
-                return json.loads(data)
-            else:
-                return {}
+    @staticmethod
+    def load_snapshot_map():
+        snapshot_map = {}
+        if Path(MAP_FILE).exists():
+            if data := gzip.decompress(Path(MAP_FILE).read_bytes()):
+                snapshot_map = json_loads(data)
+        elif Path(LEGACY_MAP_FILE).exists():
+            if data := Path(LEGACY_MAP_FILE).read_bytes():
+                snapshot_map = json_loads(data)
+        if not Path(MAP_LOG_FILE).exists():
+            return snapshot_map
+        with open(MAP_LOG_FILE, "rb") as log_file:
+            for line in log_file:
+                # a line without its newline was torn by a crash mid-write
+                if not line.endswith(b"\n") or not line.strip():
+                    continue
+                try:
+                    snapshot_map.update(json_loads(line))
+                except ValueError:
+                    # skip a damaged entry rather than lose the whole log
+                    continue
+        return snapshot_map
 
 class SpotdlClient():
 
     def __init__(self):
+        # only downloading needs an output folder, so --dump works without it
+        if not BASE_PATH:
+            raise SystemExit("Missing environment variables: BASE_PATH")
         self.spotify_client = SpotifyClient()
-        self.spotdl = Spotdl(
+        # playlist url -> (snapshot id, songs returned by Spotdl.search)
+        self.song_cache = shelve.open(SONG_CACHE_FILE)
+        self._song_cache_lock = threading.Lock()
+
+    def close(self):
+        # dbm.dumb keeps rewritten offsets in memory until the shelf closes
+        self.song_cache.close()
+        self.spotify_client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @cached_property
+    def spotdl(self):
+        # built on first use so a run with nothing to download skips auth
+        return Spotdl(
             client_id=os.environ.get("SPOTIPY_CLIENT_ID"),
             client_secret=os.environ.get("SPOTIPY_CLIENT_SECRET"),
             # threads=NUM_THREADS,
         )
     
+    def search_playlist(self, playlist_obj):
+        """
+        Search a playlist's songs, reusing the result of an earlier search
+        as long as the playlist's snapshot id has not changed.
+        """
+        url, snapshot_id = playlist_obj["url"], playlist_obj["snapshot_id"]
+        with self._song_cache_lock:
+            cached = self.song_cache.get(url)
+        if cached and cached[0] == snapshot_id:
+            return cached[1]
+        print(f"Searching for playlist '{playlist_obj['name']}' ({url})")
+        songs = self.spotdl.search([
+            url,
+        ])
+        # overwrites the entry for an older snapshot of this playlist
+        with self._song_cache_lock:
+            self.song_cache[url] = (snapshot_id, songs)
+        return songs
+
+    def filter_downloaded(self, songs, output_dir):
+        """
+        Drop songs whose output file already exists in `output_dir`, using a
+        single directory listing instead of a lookup per song.
+        """
+        existing = set(os.listdir(output_dir))
+        settings = self.spotdl.downloader.settings
+        remaining = []
+        for song in songs:
+            try:
+                file_name = create_file_name(
+                    song=song,
+                    template=settings["output"],
+                    file_extension=settings["format"],
+                    restrict=settings.get("restrict"),
+                    file_name_length=settings.get("max_filename_length"),
+                ).name
+            except Exception:
+                # songs with missing metadata can't be named yet; leave them
+                # to spotdl, which fills the data in before downloading
+                remaining.append(song)
+                continue
+            if file_name not in existing:
+                remaining.append(song)
+        return remaining
+
     def download(self):
         playlists_to_update = self.spotify_client.get_snapshot_diff()
+        if not playlists_to_update:
+            print("Everything is already up to date!")
+            return
+        # create every output folder once, outside of the retry loop
+        for playlist_obj in playlists_to_update:
+            Path(BASE_PATH, playlist_obj["name"]).mkdir(parents=True, exist_ok=True)
+        # build the client here so the search threads don't race to create it
+        spotdl = self.spotdl
         retries = MAX_DOWNLOAD_RETRIES
-        while retries > 0:
-            try:
-                for playlist_obj in playlists_to_update:
-                    playlist_name = playlist_obj.get("name")
-                    output_dir = f'{BASE_PATH}/{playlist_name}'
-                    print(f"Looking for folder '{output_dir}'")
-                    if not Path(output_dir).exists():
-                        print(f"Folder {output_dir} does not exist, creating...")
-                        Path(output_dir).mkdir(exist_ok=True)
-                        print(f"Successfully created folder '{output_dir}'")
-                    playlist_url = playlist_obj.get("url")
-                    print(f"Searching for playlist '{playlist_name}' ({playlist_url})")
-                    songs = self.spotdl.search([
-                        playlist_url,
-                    ])
-                    print(f"Downloading {len(songs)} songs...")
-                    self.spotdl.downloader.settings["output"] = output_dir
-                    results = self.spotdl.download_songs(songs)
-                    self.spotify_client.incremental_dump_map((
-                        playlist_name,
-                        self.spotify_client.target_snapshot_map.get(playlist_name),
-                    ))
-                return
-            except Exception as err:
-                print(err)
-                retries -= 1
-            print("Retrying download")
+        with self.spotify_client.batched_save():
+            while retries > 0:
+                try:
+                    # search at most SEARCH_WORKERS playlists ahead of the one
+                    # being downloaded, so a failed download only waits for
+                    # those before retrying; downloads stay serial
+                    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+                        queued = iter(playlists_to_update)
+                        searches = deque(
+                            (playlist_obj, executor.submit(self.search_playlist, playlist_obj))
+                            for playlist_obj in islice(queued, SEARCH_WORKERS)
+                        )
+                        while searches:
+                            playlist_obj, search = searches.popleft()
+                            songs = search.result()
+                            for next_obj in islice(queued, 1):
+                                searches.append((next_obj, executor.submit(self.search_playlist, next_obj)))
+                            playlist_name = playlist_obj.get("name")
+                            output_dir = f'{BASE_PATH}/{playlist_name}'
+                            spotdl.downloader.settings["output"] = output_dir
+                            songs = self.filter_downloaded(songs, output_dir)
+                            print(f"Downloading {len(songs)} songs for '{playlist_name}'...")
+                            results = spotdl.download_songs(songs)
+                            self.spotify_client.incremental_dump_map((
+                                playlist_name,
+                                self.spotify_client.target_snapshot_map.get(playlist_name),
+                            ))
+                    break
+                except Exception as err:
+                    print(err)
+                    retries -= 1
+                print("Retrying download")
+        # outside the retry loop so a failed write is reported as such
+        # instead of re-running every download
+        self.spotify_client.compact()
 
 if __name__ == "__main__":
-    spotdl_client = SpotdlClient()
-    spotdl_client.download()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dump",
+        action="store_true",
+        help="print the saved snapshot map instead of downloading",
+    )
+    args = parser.parse_args()
+    if args.dump:
+        SpotifyClient.pretty_dump()
+    else:
+        with SpotdlClient() as spotdl_client:
+            spotdl_client.download()